@@ -15,10 +15,11 @@ import argparse
 import logging
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from statistics import multimode
 from tempfile import NamedTemporaryFile, TemporaryDirectory
-from typing import List, Union
+from typing import List, Optional, Tuple, Union
 
 import numpy as np
 from osgeo import gdal, osr
@@ -26,6 +27,18 @@ from osgeo import gdal, osr
 gdal.UseExceptions()
 log = logging.getLogger(__name__)
 
+# WGS 84 / UTM zone EPSG codes for the northern (326XX) and southern (327XX) hemispheres
+UTM_EPSG_CODES = set(range(32601, 32661)) | set(range(32701, 32761))
+
+# Number of full-width output rows composited at a time
+TILE_ROWS = 1024
+
+# Maximum number of rasters reprojected concurrently
+MAX_REPROJECTION_WORKERS = 8
+
+# Maximum number of row blocks composited concurrently
+MAX_COMPOSITE_WORKERS = 4
+
 
 def get_epsg_code(info: dict) -> int:
     """Get the EPSG code from a GDAL Info dictionary
@@ -65,11 +78,7 @@ def get_target_epsg_code(codes: List[int]) -> int:
         target: UTM EPSG code
     """
     # use median east/west UTM zone of all files, regardless of hemisphere
-    # UTM EPSG codes for each hemisphere will look like:
-    #   North: 326XX
-    #   South: 327XX
-    valid_codes = list(range(32601, 32661)) + list(range(32701, 32761))
-    if bad_codes := set(codes) - set(valid_codes):
+    if bad_codes := set(codes) - UTM_EPSG_CODES:
         raise ValueError(f'Non UTM EPSG code encountered: {bad_codes}')
 
     hemispheres = [c // 100 * 100 for c in codes]
@@ -93,7 +102,8 @@ def get_area_raster(raster: str) -> str:
     Returns:
         area_raster: path of the area raster, e.g. S1A_IW_20181102T155531_DVP_RTC30_G_gpuned_5685_area.tif
     """
-    return '_'.join(raster.split('_')[:-1] + ['area.tif'])
+    extension = os.path.splitext(raster)[1]
+    return '_'.join(raster.split('_')[:-1] + [f'area{extension}'])
 
 
 def get_full_extent(raster_info: dict):
@@ -107,31 +117,85 @@ def get_full_extent(raster_info: dict):
         upper_right: The lower right corner of the extent as a tuple
         geotransform: The geotransform of the extent as a list
     """
-    upper_left_corners = [info['cornerCoordinates']['upperLeft'] for info in raster_info.values()]
-    lower_right_corners = [info['cornerCoordinates']['lowerRight'] for info in raster_info.values()]
-
-    ulx = min([ul[0] for ul in upper_left_corners])
-    uly = max([ul[1] for ul in upper_left_corners])
-    lrx = max([lr[0] for lr in lower_right_corners])
-    lry = min([lr[1] for lr in lower_right_corners])
+    # one row of (upper left x, upper left y, lower right x, lower right y) per raster
+    corners = np.array([
+        info['cornerCoordinates']['upperLeft'] + info['cornerCoordinates']['lowerRight']
+        for info in raster_info.values()
+    ])
+    ulx, _, _, lry = corners.min(axis=0).tolist()
+    _, uly, lrx, _ = corners.max(axis=0).tolist()
 
     log.debug(f'Full extent raster upper left: ({ulx, uly}); lower right: ({lrx, lry})')
 
-    trans = []
-    for info in raster_info.values():
-        # Only need info from any one raster
-        trans = info['geoTransform']
-        break
-
+    # Only need info from any one raster
+    trans = list(next(iter(raster_info.values()))['geoTransform'])
     trans[0] = ulx
     trans[3] = uly
 
     return (ulx, uly), (lrx, lry), trans
 
 
+def reproject_raster(raster: str, target_epsg_code: int, target_resolution: float, directory: str) -> str:
+    """Reprojects a raster image and its associated area raster to a given projection and resolution
+
+    Args:
+        raster: The file path to a raster image
+        target_epsg_code: The integer EPSG code for the target projection
+        target_resolution: The target resolution
+        directory: The directory in which to create the reprojected files
+
+    Returns:
+        reprojected_raster: The file path to the reprojected raster image
+    """
+    warp_kwargs = {
+        'dstSRS': f'EPSG:{target_epsg_code}', 'xRes': target_resolution, 'yRes': target_resolution,
+        'targetAlignedPixels': True, 'multithread': True, 'warpOptions': ['NUM_THREADS=2'],
+    }
+
+    log.info(f'Reprojecting {raster}')
+    reprojected_raster = os.path.join(directory, os.path.basename(raster))
+    gdal.Warp(reprojected_raster, raster, **warp_kwargs)
+
+    area_raster = get_area_raster(raster)
+    log.info(f'Reprojecting {area_raster}')
+    reprojected_area_raster = os.path.join(directory, os.path.basename(area_raster))
+    gdal.Warp(reprojected_area_raster, area_raster, **warp_kwargs)
+
+    return reprojected_raster
+
+
+def resample_raster(raster: str, target_resolution: float, directory: str) -> str:
+    """Resamples a raster image and its associated area raster to a given resolution using VRTs
+
+    No pixels are resampled up front; the VRTs defer resampling until the data is read.
+
+    Args:
+        raster: The file path to a raster image
+        target_resolution: The target resolution
+        directory: The directory in which to create the resampled VRT files
+
+    Returns:
+        resampled_raster: The file path to the resampled raster VRT
+    """
+    vrt_kwargs = {'xRes': target_resolution, 'yRes': target_resolution, 'targetAlignedPixels': True}
+
+    log.info(f'Resampling {raster}')
+    resampled_raster = os.path.join(directory, Path(raster).with_suffix('.vrt').name)
+    gdal.BuildVRT(resampled_raster, os.path.abspath(raster), **vrt_kwargs)
+
+    area_raster = get_area_raster(raster)
+    log.info(f'Resampling {area_raster}')
+    resampled_area_raster = os.path.join(directory, Path(area_raster).with_suffix('.vrt').name)
+    gdal.BuildVRT(resampled_area_raster, os.path.abspath(area_raster), **vrt_kwargs)
+
+    return resampled_raster
+
+
 def reproject_to_target(raster_info: dict, target_epsg_code: int, target_resolution: float, directory: str) -> dict:
     """Reprojects a set of raster images to a common projection and resolution
 
+    Rasters are reprojected concurrently; GDAL releases the GIL while warping.
+
     Args:
         raster_info: A dictionary of gdal.Info results for the set of rasters
         target_epsg_code: The integer EPSG code for the target projection
@@ -141,30 +205,27 @@ def reproject_to_target(raster_info: dict, target_epsg_code: int, target_resolut
     Returns:
         target_raster_info: An updated dictionary of gdal.Info results for the reprojected files
     """
-    target_raster_info = {}
-    for raster, info in raster_info.items():
-        epsg_code = get_epsg_code(info)
-        resolution = info['geoTransform'][1]
-        if epsg_code != target_epsg_code or resolution != target_resolution:
-            log.info(f'Reprojecting {raster}')
-            reprojected_raster = os.path.join(directory, os.path.basename(raster))
-            gdal.Warp(
-                reprojected_raster, raster, dstSRS=f'EPSG:{target_epsg_code}',
-                xRes=target_resolution, yRes=target_resolution, targetAlignedPixels=True
-            )
-
-            area_raster = get_area_raster(raster)
-            log.info(f'Reprojecting {area_raster}')
-            reprojected_area_raster = os.path.join(directory, os.path.basename(area_raster))
-            gdal.Warp(
-                reprojected_area_raster, area_raster, dstSRS=f'EPSG:{target_epsg_code}',
-                xRes=target_resolution, yRes=target_resolution, targetAlignedPixels=True
-            )
-
-            target_raster_info[reprojected_raster] = gdal.Info(reprojected_raster,  format='json')
-        else:
-            log.info(f'No need to reproject {raster}')
-            target_raster_info[raster] = info
+    with ThreadPoolExecutor(max_workers=MAX_REPROJECTION_WORKERS) as executor:
+        reprojections = {}
+        for raster, info in raster_info.items():
+            epsg_code = get_epsg_code(info)
+            resolution = info['geoTransform'][1]
+            if epsg_code != target_epsg_code:
+                reprojections[raster] = executor.submit(
+                    reproject_raster, raster, target_epsg_code, target_resolution, directory
+                )
+            elif resolution != target_resolution:
+                reprojections[raster] = executor.submit(resample_raster, raster, target_resolution, directory)
+            else:
+                log.info(f'No need to reproject {raster}')
+
+        target_raster_info = {}
+        for raster, info in raster_info.items():
+            if raster in reprojections:
+                reprojected_raster = reprojections[raster].result()
+                target_raster_info[reprojected_raster] = gdal.Info(reprojected_raster, format='json')
+            else:
+                target_raster_info[raster] = info
 
     return target_raster_info
 
@@ -186,6 +247,76 @@ def read_as_array(raster: str, band: int = 1) -> np.array:
     return data
 
 
+def read_window_as_array(raster: str, x_offset: int, y_offset: int, x_size: int, y_size: int,
+                         band: int = 1, dtype=None) -> np.array:
+    """Reads a rectangular window of data from a raster image into memory
+
+    Args:
+        raster: The file path to a raster image
+        x_offset: The pixel column of the upper left corner of the window
+        y_offset: The pixel row of the upper left corner of the window
+        x_size: The width of the window in pixels
+        y_size: The height of the window in pixels
+        band: The raster band to read
+        dtype: The GDAL pixel data type to read the data as, instead of the raster's data type
+
+    Returns:
+        data: The raster pixel data within the window as a numpy array
+    """
+    log.debug(f'Reading raster values from {raster} at ({x_offset}, {y_offset}) with size ({x_size}, {y_size})')
+    ds = gdal.Open(raster)
+    data = ds.GetRasterBand(band).ReadAsArray(x_offset, y_offset, x_size, y_size, buf_type=dtype)
+    del ds  # How to close w/ gdal
+    return data
+
+
+def create_geotiff(file_name: Union[str, Path], x_size: int, y_size: int, transform: List[float], epsg_code: int,
+                   dtype=gdal.GDT_Float32, nodata_value=None, options: Optional[List[str]] = None) -> gdal.Dataset:
+    """Creates an empty, single band GeoTIFF which can be written to incrementally
+
+    Args:
+        file_name: The output file name
+        x_size: The width of the raster in pixels
+        y_size: The height of the raster in pixels
+        transform: The geotransform for the output GeoTIFF
+        epsg_code: The integer EPSG code for the output GeoTIFF projection
+        dtype: The pixel data type for the output GeoTIFF
+        nodata_value: The NODATA value for the output Geotiff
+        options: GDAL GeoTIFF creation options
+
+    Returns:
+        dataset: The open GDAL dataset of the output GeoTIFF
+    """
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(str(file_name), x_size, y_size, 1, dtype, options=options or [])
+    if nodata_value is not None:
+        dataset.GetRasterBand(1).SetNoDataValue(nodata_value)
+    dataset.SetGeoTransform(transform)
+    dataset.SetProjection(epsg_to_wkt(epsg_code))
+    return dataset
+
+
+def convert_to_cog(file_name: Union[str, Path], dataset: gdal.Dataset, compress: str = 'LZW', predictor: bool = False):
+    """Creates a Cloud Optimized GeoTIFF from an open GDAL dataset
+
+    Args:
+        file_name: The output file name
+        dataset: The GDAL dataset to copy
+        compress: The compression method for the output GeoTIFF
+        predictor: Whether to apply a predictor suited to the pixel data type before compression
+
+    Returns:
+        file_name: The output file name
+    """
+    log.info(f'Creating {file_name}')
+    driver = gdal.GetDriverByName('COG')
+    options = [f'COMPRESS={compress}', 'OVERVIEW_RESAMPLING=AVERAGE', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=YES']
+    if predictor:
+        options.append('PREDICTOR=YES')
+    driver.CreateCopy(str(file_name), dataset, options=options)
+    return file_name
+
+
 def write_cog(file_name: Union[str, Path], data: np.ndarray, transform: List[float], epsg_code: int,
               dtype=gdal.GDT_Float32, nodata_value=None):
     """Creates a Cloud Optimized GeoTIFF
@@ -201,28 +332,92 @@ def write_cog(file_name: Union[str, Path], data: np.ndarray, transform: List[flo
     Returns:
         file_name: The output file name
     """
-    log.info(f'Creating {file_name}')
-
     with NamedTemporaryFile() as temp_file:
-        driver = gdal.GetDriverByName('GTiff')
-        temp_geotiff = driver.Create(temp_file.name, data.shape[1], data.shape[0], 1, dtype)
+        temp_geotiff = create_geotiff(temp_file.name, data.shape[1], data.shape[0], transform, epsg_code,
+                                      dtype=dtype, nodata_value=nodata_value)
         temp_geotiff.GetRasterBand(1).WriteArray(data)
-        if nodata_value is not None:
-            temp_geotiff.GetRasterBand(1).SetNoDataValue(nodata_value)
-        temp_geotiff.SetGeoTransform(transform)
-        temp_geotiff.SetProjection(epsg_to_wkt(epsg_code))
-
-        driver = gdal.GetDriverByName('COG')
-        options = ['COMPRESS=LZW', 'OVERVIEW_RESAMPLING=AVERAGE', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=YES']
-        driver.CreateCopy(str(file_name), temp_geotiff, options=options)
-
+        convert_to_cog(file_name, temp_geotiff)
         del temp_geotiff  # How to close w/ gdal
     return file_name
 
 
+def accumulate_window(outputs: np.ndarray, weights: np.ndarray, counts: np.ndarray, values: np.ndarray,
+                      areas: np.ndarray, y_offset: int, x_offset: int):
+    """Adds the local-resolution-weighted contribution of a raster window to the composite accumulators in place
+
+    The `values` and `areas` arrays are used as scratch space and overwritten.
+
+    Args:
+        outputs: The weighted sum of values for the composite
+        weights: The sum of weights for the composite
+        counts: The number of rasters contributing to each composite pixel
+        values: The raster values in the window
+        areas: The local contributing areas in the window
+        y_offset: The row of the accumulators corresponding to the first row of the window
+        x_offset: The column of the accumulators corresponding to the first column of the window
+    """
+    # pixels with no data or no area contribute nothing to the composite
+    valid = (values != 0) & (areas > 0)
+    # the area window is not needed after this, so reuse its buffer for the weights
+    raster_weights = np.reciprocal(areas, out=areas, where=valid)
+    # explicitly zero the rest, since they still hold the (possibly non-finite) area
+    np.copyto(raster_weights, 0, where=~valid)
+    # weight values in place to avoid allocating a temporary for the product
+    np.multiply(values, raster_weights, out=values)
+
+    window = (slice(y_offset, y_offset + values.shape[0]), slice(x_offset, x_offset + values.shape[1]))
+    outputs[window] += values
+    weights[window] += raster_weights
+    counts[window] += valid
+
+
+def composite_rows(placements: dict, row_start: int, row_end: int, x_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Creates a block of full-width rows of a local-resolution-weighted composite
+
+    Args:
+        placements: A dictionary of the location of each raster in the composite grid, as a tuple of
+            (y_index_start, x_index_start, y_size, x_size)
+        row_start: The first row of the composite grid in the block
+        row_end: The row of the composite grid after the last row in the block
+        x_size: The width of the composite grid in pixels
+
+    Returns:
+        outputs: The composite values for the block
+        counts: The number of rasters contributing to each pixel in the block
+    """
+    log.info(f'Compositing rows {row_start}:{row_end}')
+
+    outputs = np.zeros((row_end - row_start, x_size), dtype=np.float32)
+    weights = np.zeros(outputs.shape, dtype=np.float32)
+    counts = np.zeros(outputs.shape, dtype=np.uint16)
+
+    for raster, (y_index_start, x_index_start, raster_y_size, raster_x_size) in placements.items():
+        # rows of the composite grid covered by both this raster and this block
+        overlap_start = max(y_index_start, row_start)
+        overlap_end = min(y_index_start + raster_y_size, row_end)
+        if overlap_start >= overlap_end:
+            continue
+
+        window = (0, overlap_start - y_index_start, raster_x_size, overlap_end - overlap_start)
+        values = read_window_as_array(raster, *window, dtype=gdal.GDT_Float32)
+        areas = read_window_as_array(get_area_raster(raster), *window, dtype=gdal.GDT_Float32)
+
+        accumulate_window(outputs, weights, counts, values, areas,
+                          y_offset=overlap_start - row_start, x_offset=x_index_start)
+
+    # Divide by the total weight applied; pixels without any weight are left as the NODATA value, 0
+    np.reciprocal(weights, out=weights, where=weights > 0)
+    np.multiply(outputs, weights, out=outputs)
+
+    return outputs, counts
+
+
 def make_composite(out_name: str, rasters: List[str], resolution: float = None):
     """Creates a local-resolution-weighted composite from Sentinel-1 RTC products
 
+    The composite is accumulated in blocks of `TILE_ROWS` full-width rows, with up to `MAX_COMPOSITE_WORKERS` blocks
+    processed concurrently, so only the portions of each input raster overlapping those blocks are held in memory.
+
     Args:
         out_name: The base name of the output GeoTIFFs
         rasters: A list of file paths of the images to composite
@@ -236,16 +431,21 @@ def make_composite(out_name: str, rasters: List[str], resolution: float = None):
         raise ValueError('Must specify at least one raster to composite')
 
     raster_info = {}
+    epsg_codes = []
+    resolutions = []
     for raster in rasters:
-        raster_info[raster] = gdal.Info(raster, format='json')
-        # make sure gdal can read the area raster
-        gdal.Info(get_area_raster(raster))
-
-    target_epsg_code = get_target_epsg_code([get_epsg_code(info) for info in raster_info.values()])
+        info = gdal.Info(raster, format='json')
+        raster_info[raster] = info
+        epsg_codes.append(get_epsg_code(info))
+        resolutions.append(info['geoTransform'][1])
+        # make sure gdal can read the area raster; opening is enough, no need to build a full info report
+        gdal.Open(get_area_raster(raster))
+
+    target_epsg_code = get_target_epsg_code(epsg_codes)
     log.debug(f'Composite projection is EPSG:{target_epsg_code}')
 
     if resolution is None:
-        resolution = max([info['geoTransform'][1] for info in raster_info.values()])
+        resolution = max(resolutions)
     log.debug(f'Composite resolution is {resolution} meters')
 
     # resample rasters to maximum resolution & common UTM zone
@@ -254,55 +454,55 @@ def make_composite(out_name: str, rasters: List[str], resolution: float = None):
                                           directory=temp_dir)
 
         # Get extent of union of all images
-        full_ul, full_lr, full_trans = get_full_extent(raster_info)
-
-        nx = int(abs(full_ul[0] - full_lr[0]) // resolution)
-        ny = int(abs(full_ul[1] - full_lr[1]) // resolution)
-
-        outputs = np.zeros((ny, nx))
-        weights = np.zeros(outputs.shape)
-        counts = np.zeros(outputs.shape, dtype=np.int8)
+        full_ul, _, full_trans = get_full_extent(raster_info)
 
+        # location of each raster in the output grid as (y_index_start, x_index_start, y_size, x_size)
+        placements = {}
         for raster, info in raster_info.items():
-            log.info(f'Processing raster {raster}')
-            log.debug(f"Raster upper left: {info['cornerCoordinates']['upperLeft']}; "
+            log.debug(f"Raster {raster} upper left: {info['cornerCoordinates']['upperLeft']}; "
                       f"lower right: {info['cornerCoordinates']['lowerRight']}")
 
-            values = read_as_array(raster)
-
-            area_raster = get_area_raster(raster)
-            areas = read_as_array(area_raster)
-
             ulx, uly = info['cornerCoordinates']['upperLeft']
-            y_index_start = int((full_ul[1] - uly) // resolution)
-            y_index_end = y_index_start + values.shape[0]
-
-            x_index_start = int((ulx - full_ul[0]) // resolution)
-            x_index_end = x_index_start + values.shape[1]
+            # round rather than truncate so floating point error can't shift a raster by a pixel
+            y_index_start = round((full_ul[1] - uly) / resolution)
+            x_index_start = round((ulx - full_ul[0]) / resolution)
+            x_size, y_size = info['size']
 
             log.debug(
-                f'Placing values in output grid at {y_index_start}:{y_index_end} and {x_index_start}:{x_index_end}'
+                f'Placing values in output grid at {y_index_start}:{y_index_start + y_size} '
+                f'and {x_index_start}:{x_index_start + x_size}'
             )
-
-            mask = values == 0
-            raster_weights = 1.0 / areas
-            raster_weights[mask] = 0
-
-            outputs[y_index_start:y_index_end, x_index_start:x_index_end] += values * raster_weights
-            weights[y_index_start:y_index_end, x_index_start:x_index_end] += raster_weights
-            counts[y_index_start:y_index_end, x_index_start:x_index_end] += ~mask
-
-    del values, areas, mask, raster_weights
-
-    # Divide by the total weight applied
-    outputs /= weights
-    del weights
-
-    out_raster = write_cog(f'{out_name}.tif', outputs, full_trans, target_epsg_code, nodata_value=0)
-    del outputs
-
-    out_counts_raster = write_cog(f'{out_name}_counts.tif', counts, full_trans, target_epsg_code, dtype=gdal.GDT_Int16)
-    del counts
+            placements[raster] = (y_index_start, x_index_start, y_size, x_size)
+
+        # size the grid from the rounded placements so every raster fits entirely within it
+        nx = max(x_index_start + x_size for _, x_index_start, _, x_size in placements.values())
+        ny = max(y_index_start + y_size for y_index_start, _, y_size, _ in placements.values())
+
+        options = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'BIGTIFF=YES']
+        composite_geotiff = create_geotiff(os.path.join(temp_dir, 'composite.tif'), nx, ny, full_trans,
+                                           target_epsg_code, nodata_value=0, options=options)
+        counts_geotiff = create_geotiff(os.path.join(temp_dir, 'counts.tif'), nx, ny, full_trans,
+                                        target_epsg_code, dtype=gdal.GDT_UInt16, options=options)
+
+        # composite several row blocks at once; GDAL reads and NumPy ufuncs release the GIL
+        tile_starts = list(range(0, ny, TILE_ROWS))
+        with ThreadPoolExecutor(max_workers=MAX_COMPOSITE_WORKERS) as executor:
+            for batch_start in range(0, len(tile_starts), MAX_COMPOSITE_WORKERS):
+                # limit the number of blocks held in memory to one per worker
+                batch = tile_starts[batch_start:batch_start + MAX_COMPOSITE_WORKERS]
+                blocks = executor.map(
+                    lambda tile_start: composite_rows(placements, tile_start, min(tile_start + TILE_ROWS, ny), nx),
+                    batch,
+                )
+                for tile_start, (outputs, counts) in zip(batch, blocks):
+                    composite_geotiff.GetRasterBand(1).WriteArray(outputs, 0, tile_start)
+                    counts_geotiff.GetRasterBand(1).WriteArray(counts, 0, tile_start)
+
+        out_raster = convert_to_cog(f'{out_name}.tif', composite_geotiff, compress='DEFLATE', predictor=True)
+        del composite_geotiff  # How to close w/ gdal
+
+        out_counts_raster = convert_to_cog(f'{out_name}_counts.tif', counts_geotiff, compress='DEFLATE', predictor=True)
+        del counts_geotiff  # How to close w/ gdal
 
     return out_raster, out_counts_raster
 
@@ -78,6 +78,9 @@ def test_get_area_raster():
     raster = 'S1A_IW_20181102T155531_DVP_RTC30_G_gpuned_5685_VV.tif'
     assert composite.get_area_raster(raster) == 'S1A_IW_20181102T155531_DVP_RTC30_G_gpuned_5685_area.tif'
 
+    raster = 'S1A_IW_20181102T155531_DVP_RTC30_G_gpuned_5685_VV.vrt'
+    assert composite.get_area_raster(raster) == 'S1A_IW_20181102T155531_DVP_RTC30_G_gpuned_5685_area.vrt'
+
     raster = './foo/S1B_IW_20181104T030247_DVP_RTC30_G_gpuned_9F91_VH.tif'
     assert composite.get_area_raster(raster) == './foo/S1B_IW_20181104T030247_DVP_RTC30_G_gpuned_9F91_area.tif'
 
@@ -115,6 +118,41 @@ def test_get_full_extents():
     assert composite.get_full_extent(data) == (expected_upper_left, expected_lower_right, expected_geotransform)
 
 
+def test_reproject_to_target(tmp_path):
+    os.chdir(tmp_path)
+    data = np.full((4, 4), 2)
+    area = np.ones((4, 4))
+
+    transform = [600000.0, 30.0, 0.0, 5000000.0, 0.0, -30.0]
+    composite.write_cog('first_data.tif', data, transform, 32601)
+    composite.write_cog('first_area.tif', area, transform, 32601)
+
+    transform = [200000.0, 30.0, 0.0, 5000000.0, 0.0, -30.0]
+    composite.write_cog('second_data.tif', data, transform, 32602)
+    composite.write_cog('second_area.tif', area, transform, 32602)
+
+    raster_info = {raster: gdal.Info(raster, format='json') for raster in ['first_data.tif', 'second_data.tif']}
+    directory = tmp_path / 'reprojected'
+    directory.mkdir()
+
+    target_raster_info = composite.reproject_to_target(raster_info, target_epsg_code=32601, target_resolution=30.0,
+                                                       directory=str(directory))
+
+    reprojected_raster = str(directory / 'second_data.tif')
+    assert list(target_raster_info) == ['first_data.tif', reprojected_raster]
+    assert target_raster_info['first_data.tif'] is raster_info['first_data.tif']
+
+    info = target_raster_info[reprojected_raster]
+    assert composite.get_epsg_code(info) == 32601
+    assert info['geoTransform'][1] == 30.0
+
+    reprojected_area_raster = composite.get_area_raster(reprojected_raster)
+    assert reprojected_area_raster == str(directory / 'second_area.tif')
+    area_info = gdal.Info(reprojected_area_raster, format='json')
+    assert composite.get_epsg_code(area_info) == 32601
+    assert area_info['size'] == info['size']
+
+
 def test_write_cog(tmp_path):
     outfile = tmp_path / 'out.tif'
     data = np.ones((1024, 1024))
@@ -134,7 +172,42 @@ def test_write_cog(tmp_path):
     assert info['metadata']['IMAGE_STRUCTURE']['COMPRESSION'] == 'LZW'
 
 
-def test_make_composite(tmp_path):
+def test_accumulate_window():
+    outputs = np.zeros((2, 3), dtype=np.float32)
+    weights = np.zeros(outputs.shape, dtype=np.float32)
+    counts = np.zeros(outputs.shape, dtype=np.uint16)
+
+    values = np.array([[2, 0], [4, 4]], dtype=np.float32)
+    areas = np.array([[2, 2], [0, 4]], dtype=np.float32)
+    composite.accumulate_window(outputs, weights, counts, values, areas, y_offset=0, x_offset=1)
+
+    assert np.allclose(outputs, [[0, 1, 0], [0, 0, 1]])
+    assert np.allclose(weights, [[0, 0.5, 0], [0, 0, 0.25]])
+    assert np.array_equal(counts, [[0, 1, 0], [0, 0, 1]])
+
+    values = np.array([[3]], dtype=np.float32)
+    areas = np.array([[1]], dtype=np.float32)
+    composite.accumulate_window(outputs, weights, counts, values, areas, y_offset=1, x_offset=2)
+
+    assert np.allclose(outputs, [[0, 1, 0], [0, 0, 4]])
+    assert np.allclose(weights, [[0, 0.5, 0], [0, 0, 1.25]])
+    assert np.array_equal(counts, [[0, 1, 0], [0, 0, 2]])
+
+    # non-finite areas under no data, or with data, contribute nothing
+    values = np.array([[0, 5, 0]], dtype=np.float32)
+    areas = np.array([[np.nan, np.nan, np.inf]], dtype=np.float32)
+    composite.accumulate_window(outputs, weights, counts, values, areas, y_offset=0, x_offset=0)
+
+    assert np.allclose(outputs, [[0, 1, 0], [0, 0, 4]])
+    assert np.allclose(weights, [[0, 0.5, 0], [0, 0, 1.25]])
+    assert np.array_equal(counts, [[0, 1, 0], [0, 0, 2]])
+
+
+@pytest.mark.parametrize('tile_rows', [1024, 2, 1])
+def test_make_composite(tmp_path, monkeypatch, tile_rows):
+    # smaller blocks split the rasters across blocks and leave a partial last block
+    monkeypatch.setattr(composite, 'TILE_ROWS', tile_rows)
+    monkeypatch.setattr(composite, 'MAX_COMPOSITE_WORKERS', 2)
     os.chdir(tmp_path)
     epsg_code = 32601
 
@@ -169,7 +242,19 @@ def test_make_composite(tmp_path):
     assert os.path.exists(out_file)
     assert os.path.exists(count_file)
 
-    data = np.nan_to_num(composite.read_as_array(out_file))
+    info = gdal.Info(out_file, format='json')
+    assert info['metadata']['IMAGE_STRUCTURE']['LAYOUT'] == 'COG'
+    assert info['metadata']['IMAGE_STRUCTURE']['COMPRESSION'] == 'DEFLATE'
+    assert info['metadata']['IMAGE_STRUCTURE']['PREDICTOR'] == '3'
+    assert info['bands'][0]['type'] == 'Float32'
+
+    info = gdal.Info(count_file, format='json')
+    assert info['metadata']['IMAGE_STRUCTURE']['LAYOUT'] == 'COG'
+    assert info['metadata']['IMAGE_STRUCTURE']['COMPRESSION'] == 'DEFLATE'
+    assert info['metadata']['IMAGE_STRUCTURE']['PREDICTOR'] == '2'
+    assert info['bands'][0]['type'] == 'UInt16'
+
+    data = composite.read_as_array(out_file)
     expected = np.array([
         [1, 1, 1,   1, 0],
         [1, 2, 1, 1.5, 3],
@@ -184,3 +269,117 @@ def test_make_composite(tmp_path):
         [0, 1, 0, 1, 1],
     ])
     assert np.allclose(counts, expected)
+
+
+def test_make_composite_resample(tmp_path):
+    os.chdir(tmp_path)
+    epsg_code = 32601
+
+    # 30 m raster, which is resampled to the 60 m resolution of the second raster
+    transform = [0.0, 30.0, 0.0, 120.0, 0.0, -30.0]
+    data = np.array([
+        [1, 1, 2, 2],
+        [1, 1, 2, 2],
+        [3, 3, 4, 4],
+        [3, 3, 4, 4],
+    ])
+    area = np.ones((4, 4))
+    composite.write_cog('first_data.tif', data, transform, epsg_code, nodata_value=0)
+    composite.write_cog('first_area.tif', area, transform, epsg_code)
+
+    transform = [0.0, 60.0, 0.0, 120.0, 0.0, -60.0]
+    data = np.array([
+        [3, 4],
+        [5, 6],
+    ])
+    area = np.ones((2, 2))
+    composite.write_cog('second_data.tif', data, transform, epsg_code)
+    composite.write_cog('second_area.tif', area, transform, epsg_code)
+
+    out_file, count_file = composite.make_composite('out', ['first_data.tif', 'second_data.tif'])
+
+    info = gdal.Info(out_file, format='json')
+    assert info['geoTransform'] == [0.0, 60.0, 0.0, 120.0, 0.0, -60.0]
+
+    data = composite.read_as_array(out_file)
+    expected = np.array([
+        [2, 3],
+        [4, 5],
+    ])
+    assert np.allclose(data, expected)
+
+    counts = composite.read_as_array(count_file)
+    assert np.array_equal(counts, np.full((2, 2), 2))
+
+
+def test_make_composite_half_pixel_offset(tmp_path):
+    os.chdir(tmp_path)
+    epsg_code = 32601
+
+    transform = [0.0, 30.0, 0.0, 60.0, 0.0, -30.0]
+    data = np.array([
+        [1],
+        [1],
+    ])
+    area = np.array([
+        [1],
+        [1],
+    ])
+    composite.write_cog('first_data.tif', data, transform, epsg_code, nodata_value=0)
+    composite.write_cog('first_area.tif', area, transform, epsg_code)
+
+    transform = [45.0, 30.0, 0.0, 60.0, 0.0, -30.0]
+    data = np.array([
+        [2, 2, 2],
+        [2, 2, 2],
+    ])
+    area = np.array([
+        [1, 1, 1],
+        [1, 1, 1],
+    ])
+    composite.write_cog('second_data.tif', data, transform, epsg_code)
+    composite.write_cog('second_area.tif', area, transform, epsg_code)
+
+    out_file, count_file = composite.make_composite('out', ['first_data.tif', 'second_data.tif'])
+
+    data = composite.read_as_array(out_file)
+    expected = np.array([
+        [1, 0, 2, 2, 2],
+        [1, 0, 2, 2, 2],
+    ])
+    assert np.allclose(data, expected)
+
+    counts = composite.read_as_array(count_file)
+    expected = np.array([
+        [1, 0, 1, 1, 1],
+        [1, 0, 1, 1, 1],
+    ])
+    assert np.allclose(counts, expected)
+
+
+def test_make_composite_reproject(tmp_path):
+    os.chdir(tmp_path)
+    data = np.full((4, 4), 2)
+    area = np.ones((4, 4))
+
+    transform = [600000.0, 30.0, 0.0, 5000000.0, 0.0, -30.0]
+    composite.write_cog('first_data.tif', data, transform, 32601)
+    composite.write_cog('first_area.tif', area, transform, 32601)
+
+    # reprojected to UTM zone 1, where it doesn't overlap the first raster
+    transform = [200000.0, 30.0, 0.0, 5000000.0, 0.0, -30.0]
+    composite.write_cog('second_data.tif', data, transform, 32602)
+    composite.write_cog('second_area.tif', area, transform, 32602)
+
+    out_file, count_file = composite.make_composite('out', ['first_data.tif', 'second_data.tif'])
+
+    assert composite.get_epsg_code(gdal.Info(out_file, format='json')) == 32601
+
+    data = composite.read_as_array(out_file)
+    assert np.all(np.isin(data, [0, 2]))
+
+    # both the first raster's 16 pixels and the reprojected raster contribute
+    counts = composite.read_as_array(count_file)
+    assert counts.max() == 1
+    assert counts.sum() > 16
+    assert np.array_equal(counts == 1, data == 2)